@@ -0,0 +1,573 @@
+#include <algorithm>
+#include <vector>
+
+#include <Python.h>
+#include <opcode.h>
+
+namespace gotenks {
+
+// We only know the layout of the 3.6 and 3.7 wordcode, on any other version
+// `compose_functions` always declines to write the bytecode.
+#define GOTENKS_WORDCODE (PY_MINOR_VERSION >= 6 && PY_MINOR_VERSION < 8)
+
+#if GOTENKS_WORDCODE
+/** A single byte of wordcode.
+ */
+using codeunit = unsigned char;
+
+/** Does this instruction touch globals, names, or closure cells?
+
+    These are the instructions that `gotenks.inline.can_inline` rejects.
+ */
+inline bool is_disallowed(int op) {
+    switch (op) {
+    case LOAD_GLOBAL:
+    case STORE_GLOBAL:
+    case DELETE_GLOBAL:
+    case DELETE_NAME:
+    case LOAD_NAME:
+    case STORE_NAME:
+    case LOAD_DEREF:
+    case STORE_DEREF:
+    case LOAD_CLOSURE:
+    case DELETE_DEREF:
+    case LOAD_CLASSDEREF:
+        return true;
+    default:
+        return false;
+    }
+}
+
+/** Is the argument to this instruction an index into `co_varnames`?
+ */
+inline bool is_local(int op) {
+    return op == LOAD_FAST || op == STORE_FAST || op == DELETE_FAST;
+}
+
+/** Is the argument to this instruction an index into `co_names`?
+ */
+inline bool is_name(int op) {
+    switch (op) {
+    case STORE_ATTR:
+    case DELETE_ATTR:
+    case LOAD_ATTR:
+    case IMPORT_NAME:
+    case IMPORT_FROM:
+#ifdef LOAD_METHOD
+    case LOAD_METHOD:
+#endif
+        return true;
+    default:
+        return false;
+    }
+}
+
+/** Is the argument to this instruction an absolute bytecode offset?
+ */
+inline bool is_absolute_jump(int op) {
+    switch (op) {
+    case JUMP_IF_FALSE_OR_POP:
+    case JUMP_IF_TRUE_OR_POP:
+    case JUMP_ABSOLUTE:
+    case POP_JUMP_IF_FALSE:
+    case POP_JUMP_IF_TRUE:
+    case CONTINUE_LOOP:
+        return true;
+    default:
+        return false;
+    }
+}
+
+/** The part of a function's bytecode to splice into the composed function,
+    or a function to call from the composed function.
+ */
+struct body {
+    /** The code object this body comes from, or nullptr if `function` is
+        called instead.
+     */
+    PyCodeObject* code;
+
+    /** The function to call if the code cannot be spliced.
+     */
+    PyObject* function;
+
+    /** The offset of the first instruction to copy.
+     */
+    Py_ssize_t start;
+
+    /** The offset one past the last instruction to copy.
+     */
+    Py_ssize_t stop;
+
+    /** Should the result of the previous body be stored into the argument
+        before running this body?
+     */
+    bool store;
+};
+
+/** The flags a code object may have and still be spliced.
+ */
+constexpr int allowed_flags =
+    CO_OPTIMIZED | CO_NEWLOCALS | CO_NESTED | CO_NOFREE;
+
+/** Check if a code object takes exactly one positional argument.
+ */
+inline bool is_unary(PyCodeObject* code) {
+    return code->co_argcount == 1 &&
+        !code->co_kwonlyargcount &&
+        !(code->co_flags & (CO_VARARGS | CO_VARKEYWORDS));
+}
+
+/** Check if a code object can be spliced into a composed function and find
+    the part of it to copy.
+
+    @param code The code object to check.
+    @param first Is this the first function to be applied?
+    @param last Is this the last function to be applied?
+    @param out The body to fill in.
+    @return Can `code` be spliced?
+ */
+bool read_body(PyCodeObject* code, bool first, bool last, body& out) {
+    if (!is_unary(code) ||
+        code->co_flags & ~allowed_flags ||
+        PyTuple_GET_SIZE(code->co_cellvars) ||
+        PyTuple_GET_SIZE(code->co_freevars)) {
+        return false;
+    }
+
+    const codeunit* bytes =
+        reinterpret_cast<const codeunit*>(PyBytes_AS_STRING(code->co_code));
+    Py_ssize_t size = PyBytes_GET_SIZE(code->co_code);
+
+    bool uses_arg = false;
+    bool jumps_to_start = false;
+    for (Py_ssize_t ix = 0; ix < size; ix += 2) {
+        int op = bytes[ix];
+        int arg = bytes[ix + 1];
+
+        if (op == EXTENDED_ARG || is_disallowed(op)) {
+            return false;
+        }
+        if (op == RETURN_VALUE && !last && ix != size - 2) {
+            // only the final return can fall through into the next body
+            return false;
+        }
+        if (is_local(op) && arg == 0 && ix != 0) {
+            uses_arg = true;
+        }
+        if (is_absolute_jump(op) && arg == 0) {
+            jumps_to_start = true;
+        }
+    }
+
+    out.code = code;
+    out.function = nullptr;
+    out.start = 0;
+    out.stop = size;
+    out.store = false;
+
+    if (!last) {
+        if (size < 2 || bytes[size - 2] != RETURN_VALUE) {
+            return false;
+        }
+        // drop the return; the value is left on the stack for the next body
+        // and anything that jumped to the return now jumps to the next body
+        out.stop -= 2;
+    }
+
+    if (!first) {
+        if (bytes[0] == LOAD_FAST && bytes[1] == 0 &&
+            !uses_arg && !jumps_to_start) {
+            // the argument is only loaded once, right away; the previous
+            // body already left it on the stack
+            out.start = 2;
+        }
+        else {
+            out.store = true;
+        }
+    }
+
+    return true;
+}
+
+/** Build a tuple from a vector of borrowed references.
+
+    @param items The items of the tuple.
+    @return The new tuple.
+ */
+PyObject* to_tuple(const std::vector<PyObject*>& items) {
+    PyObject* out = PyTuple_New(items.size());
+    if (!out) {
+        return nullptr;
+    }
+
+    Py_ssize_t ix = 0;
+    for (PyObject* ob : items) {
+        Py_INCREF(ob);
+        PyTuple_SET_ITEM(out, ix++, ob);
+    }
+    return out;
+}
+
+/** Concatenate a tuple field of each spliced body's code object.
+
+    @param bodies The bodies to read from.
+    @param field The tuple field of the code object.
+    @param skip The number of leading items to skip in each tuple.
+    @param prefix The items to start the tuple with.
+    @return The new tuple.
+ */
+PyObject* concat(const std::vector<body>& bodies,
+                 PyObject* PyCodeObject::*field,
+                 Py_ssize_t skip,
+                 std::vector<PyObject*> prefix) {
+    Py_ssize_t size = prefix.size();
+    for (const body& b : bodies) {
+        if (b.code) {
+            size += PyTuple_GET_SIZE(b.code->*field) - skip;
+        }
+    }
+
+    PyObject* out = PyTuple_New(size);
+    if (!out) {
+        return nullptr;
+    }
+
+    Py_ssize_t ix = 0;
+    for (PyObject* ob : prefix) {
+        Py_INCREF(ob);
+        PyTuple_SET_ITEM(out, ix++, ob);
+    }
+    for (const body& b : bodies) {
+        if (!b.code) {
+            continue;
+        }
+
+        PyObject* items = b.code->*field;
+        for (Py_ssize_t n = skip; n < PyTuple_GET_SIZE(items); ++n) {
+            PyObject* ob = PyTuple_GET_ITEM(items, n);
+            Py_INCREF(ob);
+            PyTuple_SET_ITEM(out, ix++, ob);
+        }
+    }
+
+    return out;
+}
+
+/** Write a single instruction.
+
+    @param out The wordcode to write to.
+    @param op The opcode.
+    @param arg The argument.
+    @return Did the argument fit in a single byte?
+ */
+inline bool emit(std::vector<codeunit>& out, int op, Py_ssize_t arg = 0) {
+    if (arg > 0xff) {
+        return false;
+    }
+    out.push_back(op);
+    out.push_back(arg);
+    return true;
+}
+
+/** Find the index of a constant, adding it if it is not there yet.
+
+    Constants are compared by identity so that equal constants of different
+    types, like `1` and `1.0`, are kept apart. A string is never put in slot
+    0, which is read as the docstring.
+
+    @param consts The constants of the composed code.
+    @param ob The constant to find.
+    @return The index of `ob` in `consts`.
+ */
+Py_ssize_t add_const(std::vector<PyObject*>& consts, PyObject* ob) {
+    auto it = std::find(consts.begin(), consts.end(), ob);
+    if (it != consts.end()) {
+        return it - consts.begin();
+    }
+    if (consts.empty() && PyUnicode_Check(ob)) {
+        consts.push_back(Py_None);
+    }
+    consts.push_back(ob);
+    return consts.size() - 1;
+}
+
+/** Splice the bodies together into a single wordcode string.
+
+    @param bodies The bodies to splice, in application order.
+    @param out The wordcode to write to.
+    @param consts The constants of the composed code, as borrowed
+           references.
+    @param called The functions which are called instead of spliced, in the
+           order of the free variables that hold them.
+    @param stacksize The stack size needed by the composed code.
+    @return Could the bodies be spliced? This fails if any argument is too
+            large to fit in a single byte.
+ */
+bool splice(const std::vector<body>& bodies,
+            std::vector<codeunit>& out,
+            std::vector<PyObject*>& consts,
+            std::vector<PyObject*>& called,
+            int& stacksize) {
+    Py_ssize_t name_base = 0;
+    Py_ssize_t local_base = 1;
+    stacksize = 0;
+
+    for (const body& b : bodies) {
+        if (!b.code) {
+            // call the function on the value on top of the stack, or on the
+            // argument if this is the first function; the function is held
+            // in a closure cell rather than a constant because the cycle
+            // collector does not look inside code objects
+            if (!emit(out, LOAD_DEREF, called.size())) {
+                return false;
+            }
+            called.push_back(b.function);
+            if (&b == &bodies.front()) {
+                emit(out, LOAD_FAST, 0);
+            }
+            else {
+                emit(out, ROT_TWO);
+            }
+            emit(out, CALL_FUNCTION, 1);
+            if (&b == &bodies.back()) {
+                emit(out, RETURN_VALUE);
+            }
+            stacksize = std::max(stacksize, 2);
+            continue;
+        }
+
+        if (b.store) {
+            emit(out, STORE_FAST, 0);
+        }
+
+        // only copy the constants which are loaded; this skips the unused
+        // docstring slot
+        PyObject* code_consts = b.code->co_consts;
+        std::vector<Py_ssize_t> const_ix(PyTuple_GET_SIZE(code_consts), -1);
+
+        Py_ssize_t base = out.size();
+        const codeunit* bytes =
+            reinterpret_cast<const codeunit*>(
+                PyBytes_AS_STRING(b.code->co_code));
+        for (Py_ssize_t ix = b.start; ix < b.stop; ix += 2) {
+            int op = bytes[ix];
+            Py_ssize_t arg = bytes[ix + 1];
+
+            if (op == LOAD_CONST) {
+                if (const_ix[arg] < 0) {
+                    const_ix[arg] =
+                        add_const(consts, PyTuple_GET_ITEM(code_consts, arg));
+                }
+                arg = const_ix[arg];
+            }
+            else if (is_name(op)) {
+                arg += name_base;
+            }
+            else if (is_local(op) && arg) {
+                // every body shares slot 0 for its argument
+                arg += local_base - 1;
+            }
+            else if (is_absolute_jump(op)) {
+                arg += base - b.start;
+            }
+
+            if (!emit(out, op, arg)) {
+                return false;
+            }
+        }
+
+        name_base += PyTuple_GET_SIZE(b.code->co_names);
+        local_base += PyTuple_GET_SIZE(b.code->co_varnames) - 1;
+        stacksize = std::max(stacksize, b.code->co_stacksize);
+    }
+
+    return true;
+}
+#endif
+
+PyDoc_STRVAR(compose_functions_doc,
+             "Compose functions by writing the bytecode of the composition\n"
+             "directly.\n"
+             "\n"
+             "Parameters\n"
+             "----------\n"
+             "functions : tuple[callable]\n"
+             "    The functions to compose in application order, so the\n"
+             "    first function is called first.\n"
+             "name : str\n"
+             "    The name of the new code object.\n"
+             "\n"
+             "Returns\n"
+             "-------\n"
+             "composed : (code, tuple or None) or None\n"
+             "    The code object for the composition and the closure to\n"
+             "    create the function with, or None if it could not be\n"
+             "    written directly.\n"
+             "\n"
+             "Notes\n"
+             "-----\n"
+             "The bodies of simple unary functions are spliced into the new\n"
+             "code. Any other callable is stored in a closure cell and\n"
+             "called.\n");
+
+PyObject* compose_functions(PyObject*, PyObject* args) {
+    PyObject* functions;
+    PyObject* name;
+    if (!PyArg_ParseTuple(args,
+                          "O!U:compose_functions",
+                          &PyTuple_Type,
+                          &functions,
+                          &name)) {
+        return nullptr;
+    }
+
+#if !GOTENKS_WORDCODE
+    Py_RETURN_NONE;
+#else
+    Py_ssize_t size = PyTuple_GET_SIZE(functions);
+    if (!size) {
+        Py_RETURN_NONE;
+    }
+
+    std::vector<body> bodies(size);
+    for (Py_ssize_t ix = 0; ix < size; ++ix) {
+        PyObject* function = PyTuple_GET_ITEM(functions, ix);
+        body& b = bodies[ix];
+
+        if (PyFunction_Check(function)) {
+            PyCodeObject* code =
+                reinterpret_cast<PyCodeObject*>(PyFunction_GET_CODE(function));
+            if (read_body(code, ix == 0, ix == size - 1, b)) {
+                continue;
+            }
+            if (ix == 0 && !is_unary(code)) {
+                // the composition takes the signature of the first function
+                Py_RETURN_NONE;
+            }
+        }
+        else if (!PyCallable_Check(function)) {
+            // let the caller report the error
+            Py_RETURN_NONE;
+        }
+
+        b.code = nullptr;
+        b.function = function;
+    }
+
+    std::vector<codeunit> instrs;
+    std::vector<PyObject*> const_items;
+    std::vector<PyObject*> called;
+    int stacksize;
+    if (!splice(bodies, instrs, const_items, called, stacksize)) {
+        Py_RETURN_NONE;
+    }
+
+    PyObject* argname;
+    PyObject* first = PyTuple_GET_ITEM(functions, 0);
+    if (PyFunction_Check(first)) {
+        PyCodeObject* code =
+            reinterpret_cast<PyCodeObject*>(PyFunction_GET_CODE(first));
+        argname = PyTuple_GET_ITEM(code->co_varnames, 0);
+        Py_INCREF(argname);
+    }
+    else {
+        argname = PyUnicode_InternFromString("n");
+    }
+
+    PyObject* co_code = PyBytes_FromStringAndSize(
+        reinterpret_cast<const char*>(instrs.data()),
+        instrs.size());
+    PyObject* consts = to_tuple(const_items);
+    PyObject* names = concat(bodies, &PyCodeObject::co_names, 0, {});
+    PyObject* varnames = nullptr;
+    if (argname) {
+        varnames =
+            concat(bodies, &PyCodeObject::co_varnames, 1, {argname});
+    }
+    PyObject* freevars = PyTuple_New(called.size());
+    PyObject* closure = PyTuple_New(called.size());
+    if (freevars && closure) {
+        for (std::size_t ix = 0; ix < called.size(); ++ix) {
+            PyObject* freevar = PyUnicode_FromFormat("_%zu", ix);
+            PyObject* cell = PyCell_New(called[ix]);
+            PyTuple_SET_ITEM(freevars, ix, freevar);
+            PyTuple_SET_ITEM(closure, ix, cell);
+            if (!freevar || !cell) {
+                Py_CLEAR(freevars);
+                break;
+            }
+        }
+    }
+    PyObject* empty = PyTuple_New(0);
+    PyObject* filename = PyUnicode_FromString("<code>");
+    PyObject* lnotab = PyBytes_FromStringAndSize(nullptr, 0);
+
+    PyObject* out = nullptr;
+    if (co_code && consts && names && varnames && freevars && closure &&
+        empty && filename && lnotab) {
+        int flags = CO_OPTIMIZED | CO_NEWLOCALS;
+        if (called.empty()) {
+            flags |= CO_NOFREE;
+        }
+        PyObject* code = reinterpret_cast<PyObject*>(
+            PyCode_New(1,                               // argcount
+                       0,                               // kwonlyargcount
+                       PyTuple_GET_SIZE(varnames),      // nlocals
+                       stacksize,                       // stacksize
+                       flags,                           // flags
+                       co_code,                         // code
+                       consts,                          // consts
+                       names,                           // names
+                       varnames,                        // varnames
+                       freevars,                        // freevars
+                       empty,                           // cellvars
+                       filename,                        // filename
+                       name,                            // name
+                       1,                               // firstlineno
+                       lnotab));                        // lnotab
+        if (code) {
+            out = Py_BuildValue("(NO)",
+                                code,
+                                called.empty() ? Py_None : closure);
+        }
+    }
+
+    Py_XDECREF(argname);
+    Py_XDECREF(co_code);
+    Py_XDECREF(consts);
+    Py_XDECREF(names);
+    Py_XDECREF(varnames);
+    Py_XDECREF(freevars);
+    Py_XDECREF(closure);
+    Py_XDECREF(empty);
+    Py_XDECREF(filename);
+    Py_XDECREF(lnotab);
+    return out;
+#endif
+}
+
+PyMethodDef free_functions[] = {
+    {"compose_functions",
+     compose_functions,
+     METH_VARARGS,
+     compose_functions_doc},
+    {nullptr},
+};
+
+PyModuleDef module = {
+    PyModuleDef_HEAD_INIT,
+    "gotenks._compose",
+    nullptr,
+    -1,
+    free_functions,
+    nullptr,
+    nullptr,
+    nullptr,
+    nullptr,
+};
+}  // namespace gotenks
+
+PyMODINIT_FUNC PyInit__compose() {
+    return PyModule_Create(&gotenks::module);
+}
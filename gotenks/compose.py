@@ -1,148 +1,121 @@
-from itertools import chain
-from types import FunctionType, BuiltinMethodType, BuiltinFunctionType
-
-from codetransformer import Code, CodeTransformer, pattern
-from codetransformer.instructions import (
-    CALL_FUNCTION,
-    DELETE_DEREF,
-    DELETE_GLOBAL,
-    DELETE_NAME,
-    JUMP_ABSOLUTE,
-    LOAD_CLOSURE,
-    LOAD_CONST,
-    LOAD_DEREF,
-    LOAD_FAST,
-    LOAD_GLOBAL,
-    LOAD_NAME,
-    RETURN_VALUE,
-    ROT_TWO,
-    STORE_DEREF,
-    STORE_FAST,
-    STORE_GLOBAL,
-    STORE_NAME,
-)
-
-
-class InlineTransformer(CodeTransformer):
-    def __init__(self, next_instr, argname, first):
-        super().__init__()
-        self._next_instr = next_instr
-        self._argname = argname
-        self._first = first
-
-    @pattern(LOAD_FAST)
-    def _loadfast(self, instr):
-        if (not self._first and
-                instr.arg == self._argname
-                and instr is self.code.instrs[0]):
-            # If this is is not the first code object and
-            # the first instruction is LOAD_FAST, just
-            # ignore it.
-            return
-
-        yield instr
-
-    @pattern(RETURN_VALUE)
-    def _return(self, instr):
-        if self._next_instr is None:
-            # Actually just return if this is the last code object.
-            yield instr
-            return
-
-        stolen = False
-        next_instr = self._next_instr
-        if not (isinstance(next_instr, LOAD_FAST) and
-                next_instr.arg == self._argname):
-            # Only store if we are not going to loading
-            # the value immediately.
-            stolen = True
-            yield STORE_FAST(self._argname).steal(instr)
-
-        if instr is not self.code.instrs[-1]:
-            # Only jump if we are not the last instruction.
-            jmp = JUMP_ABSOLUTE(self._next_instr)
-            if not stolen:
-                jmp.steal(instr)
-            yield jmp
-
-    def transform_varnames(self, varnames):
-        return (self._argname,) + varnames[1:]
+from types import FunctionType
+from weakref import WeakValueDictionary
 
+from gotenks._compose import compose_functions
 
-def can_inline(code):
-    """Checks if we can inline the given function.
+
+# Functions which are created again, for example in a loop, miss the
+# compose cache but produce the same bytecode. Equal bodies share one code
+# object for as long as it is alive. Constants are keyed on their identity:
+# code objects compare their constants with ``==`` before 3.6, which would
+# merge compositions of callables that compare equal, or of ``1`` and ``1.0``.
+# The interned code object keeps its constants alive, so their ids cannot be
+# reused while the entry exists.
+_code_table = WeakValueDictionary()
+
+
+def _intern_code(code):
+    """Return a shared code object equivalent to ``code``.
 
     Parameters
     ----------
-    code : Code
-        The code object.
+    code : code
+        The code object to intern.
 
     Returns
     -------
-    g : bool
-        Can code be inlined?
+    interned : code
+        A code object with the same bytecode, names, and constants as
+        ``code``.
+    """
+    key = (
+        code.co_code,
+        code.co_argcount,
+        code.co_flags,
+        code.co_names,
+        code.co_varnames,
+        code.co_name,
+        tuple((type(c), id(c)) for c in code.co_consts),
+    )
+    return _code_table.setdefault(key, code)
+
+
+# These live in gotenks.inline with the rest of the code that needs
+# codetransformer. The wrappers keep them importable from here without
+# importing codetransformer until they are called.
+
+
+def can_inline(code):
+    """Checks if we can inline the given function.
+
+    See :func:`gotenks.inline.can_inline`.
     """
-    for c in code.instrs:
-        # These are closures or interact with the globals.
-        if isinstance(c, (LOAD_GLOBAL,
-                          STORE_GLOBAL,
-                          DELETE_GLOBAL,
-                          DELETE_NAME,
-                          LOAD_NAME,
-                          STORE_NAME,
-                          LOAD_DEREF,
-                          STORE_DEREF,
-                          LOAD_CLOSURE,
-                          DELETE_DEREF)):
-            return False
-
-    return True
+    from gotenks import inline
+
+    return inline.can_inline(code)
 
 
 def call_function(fn):
     """Return the instructions needed to call fn.
 
-    Parameters
-    ----------
-    fn : function
-        The function to call.
-
-    Returns
-    -------
-    instrs : tuple
-        The instructions to use.
+    See :func:`gotenks.inline.call_function`.
     """
-    return LOAD_CONST(fn), ROT_TWO(), CALL_FUNCTION(1)
+    from gotenks import inline
+
+    return inline.call_function(fn)
 
 
-def extract_code(n, *, _tried_call=False):
+def extract_code(n):
     """Extract a Code object from a callable.
 
+    See :func:`gotenks.inline.extract_code`.
+    """
+    from gotenks import inline
+
+    return inline.extract_code(n)
+
+
+def _compose(fs, defaults):
+    """Compose functions together without consulting the cache.
+
     Parameters
     ----------
-    n : callable
-        The callable to extract code from.
+    fs : tuple[callable]
+        The functions to compose, outermost first.
+    defaults : tuple or None
+        The defaults of the innermost function.
 
     Returns
-    code : Code
-        The code object.
+    -------
+    composed : function
+        The compositions of all of the functions.
     """
-    if isinstance(n, FunctionType):
-        return Code.from_pycode(n.__code__)
-    if isinstance(n, (BuiltinFunctionType, BuiltinMethodType)):
-        return None
-
-    if _tried_call:
-        # Use this because the `__call__` attribute will probable
-        # also have a `__call__` that might be the same.
-        return None
-
     try:
-        call = n.__call__
+        name = '_of_'.join(f.__name__ for f in fs)
     except AttributeError:
-        raise TypeError('{n} is not callable'.format(n=n))
+        name = 'composed'
+
+    # Try to write the bytecode directly before falling back to rewriting it
+    # with codetransformer.
+    composed = compose_functions(tuple(reversed(fs)), name)
+    if composed is not None:
+        code, closure = composed
+        return FunctionType(_intern_code(code), {}, name, defaults, closure)
+
+    # codetransformer is slow to import and is only needed when the bytecode
+    # cannot be written directly.
+    from gotenks.inline import compose_inline
+
+    return compose_inline(fs, name, defaults)
 
-    return extract_code(call, _tried_call=True)
+
+# Building the pipeline ``fused.map(f, fused.map(g, ...))`` over and over
+# composes the same functions each time. The cache is keyed on the identity of
+# everything the composition reads: the functions, their code, and the
+# defaults of the innermost function. Each cached function keeps those
+# objects alive so the ids in its key cannot be reused, and its entry goes
+# away with it.
+_composed = WeakValueDictionary()
 
 
 def compose(*fs):
@@ -158,6 +131,13 @@ def compose(*fs):
     -------
     composed : function
         The compositions of all of the functions.
+
+    Notes
+    -----
+    The results are cached on the identity of the functions, their code, and
+    the defaults of the innermost function. Composing the same functions
+    again returns the same function object for as long as that object is
+    alive.
     """
     if not fs:
         return lambda n: n
@@ -165,51 +145,18 @@ def compose(*fs):
     if len(fs) == 1:
         return fs[0]
 
-    try:
-        name = '_of_'.join(f.__name__ for f in fs)
-    except AttributeError:
-        name = 'composed'
-
-    fs = tuple(reversed(fs))
-    cs = tuple(map(extract_code, fs))
-    argname = cs[0].argnames[0] if cs[0] is not None else 'n'
-    new_instrs = []
-    append_instrs = new_instrs.append
-    first_func = fs[0]
-    last_func = fs[-1]
-    first_code = cs[0]
-    next_instr = None
-    for f, c in zip(fs[::-1], cs[::-1]):
-        if c is not None and can_inline(c):
-            instrs = InlineTransformer(
-                next_instr,
-                argname=argname,
-                first=c is first_code,
-            ).transform(c).instrs
-            next_instr = c.instrs[0]
-        else:
-            instrs = call_function(f)
-            if f is first_func:
-                instrs = (LOAD_FAST(argname),) + instrs
-            elif f is last_func:
-                instrs += (RETURN_VALUE(),)
-            next_instr = LOAD_FAST(argname)
-
-        append_instrs(instrs)
-
-    try:
-        defaults = fs[0].__defaults__
-    except AttributeError:
-        defaults = ()
-
-    return FunctionType(
-        Code(
-            chain.from_iterable(reversed(new_instrs)),
-            first_code.argnames if first_code is not None else ('n',),
-            name=name,
-        ).to_pycode(),
-        {},
-        name,
-        defaults,
-        sum((getattr(f, '__closure__', None) or () for f in fs), ()),
-    )
+    defaults = getattr(fs[-1], '__defaults__', None)
+    inputs = fs + tuple([
+        f.__code__ if type(f) is FunctionType else None
+        for f in fs
+    ]) + (defaults,)
+    key = tuple(map(id, inputs))
+    composed = _composed.get(key)
+    if composed is None:
+        composed = _composed[key] = _compose(fs, defaults)
+        # Store the inputs on the function itself rather than in another
+        # table so that an input which refers back to the result forms a
+        # cycle the garbage collector can break.
+        composed._gotenks_inputs = inputs
+
+    return composed
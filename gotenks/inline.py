@@ -0,0 +1,490 @@
+from types import FunctionType, BuiltinMethodType, BuiltinFunctionType
+from weakref import finalize
+
+from codetransformer import Code
+from codetransformer.instructions import (
+    CALL_FUNCTION,
+    DELETE_DEREF,
+    DELETE_FAST,
+    DELETE_GLOBAL,
+    DELETE_NAME,
+    JUMP_ABSOLUTE,
+    LOAD_CLASSDEREF,
+    LOAD_CLOSURE,
+    LOAD_CONST,
+    LOAD_DEREF,
+    LOAD_FAST,
+    LOAD_GLOBAL,
+    LOAD_NAME,
+    RETURN_VALUE,
+    ROT_TWO,
+    STORE_DEREF,
+    STORE_FAST,
+    STORE_GLOBAL,
+    STORE_NAME,
+)
+
+from gotenks.compose import _intern_code
+
+
+# These are closures or interact with the globals. None of the instruction
+# types are subclassed so we can check membership by exact type.
+_NOT_INLINABLE = frozenset({
+    LOAD_GLOBAL,
+    STORE_GLOBAL,
+    DELETE_GLOBAL,
+    DELETE_NAME,
+    LOAD_NAME,
+    STORE_NAME,
+    LOAD_DEREF,
+    STORE_DEREF,
+    LOAD_CLOSURE,
+    DELETE_DEREF,
+    LOAD_CLASSDEREF,
+})
+
+
+# The instructions whose argument is a local variable name.
+_LOCAL_INSTRS = frozenset({LOAD_FAST, STORE_FAST, DELETE_FAST})
+
+
+def can_inline(code):
+    """Checks if we can inline the given function.
+
+    Parameters
+    ----------
+    code : Code
+        The code object.
+
+    Returns
+    -------
+    g : bool
+        Can code be inlined?
+    """
+    for c in code.instrs:
+        if type(c) in _NOT_INLINABLE:
+            return False
+
+    return True
+
+
+# The instructions used to call a function that cannot be inlined.
+# Instructions are mutable, but these are never the target of a jump and are
+# never stolen from, so one instance can be shared by every composition.
+_ROT_TWO = ROT_TWO()
+_CALL_ONE = CALL_FUNCTION(1)
+
+
+def call_function(fn):
+    """Return the instructions needed to call fn.
+
+    Parameters
+    ----------
+    fn : function
+        The function to call.
+
+    Returns
+    -------
+    instrs : tuple
+        The instructions to use.
+    """
+    return LOAD_CONST(fn), _ROT_TWO, _CALL_ONE
+
+
+def _call_free(name):
+    """Return the instructions needed to call the function in a free
+    variable.
+
+    Parameters
+    ----------
+    name : str
+        The name of the free variable.
+
+    Returns
+    -------
+    instrs : tuple
+        The instructions to use.
+
+    Notes
+    -----
+    The composed function holds the functions it calls in closure cells
+    rather than constants because the cycle collector does not look inside
+    code objects. A callable which refers back to the composition would
+    otherwise never be freed.
+    """
+    return LOAD_DEREF(name), _ROT_TWO, _CALL_ONE
+
+
+def _make_cell(value):
+    return (lambda: value).__closure__[0]
+
+
+def extract_code(n, *, _tried_call=False):
+    """Extract a Code object from a callable.
+
+    Parameters
+    ----------
+    n : callable
+        The callable to extract code from.
+
+    Returns
+    code : Code
+        The code object.
+    """
+    # Check the exact type first; plain functions and builtins are by far
+    # the most common inputs and cannot be subclassed.
+    t = type(n)
+    if t is FunctionType:
+        return Code.from_pycode(n.__code__)
+    if t is BuiltinFunctionType or t is BuiltinMethodType:
+        return None
+
+    if _tried_call:
+        # Use this because the `__call__` attribute will probable
+        # also have a `__call__` that might be the same.
+        return None
+
+    try:
+        call = n.__call__
+    except AttributeError:
+        raise TypeError('{n} is not callable'.format(n=n))
+
+    return extract_code(call, _tried_call=True)
+
+
+# Maps ``id(co)`` to the ``Code`` object for ``co`` and whether it can be
+# inlined. Parsing is by far the slowest part of inlining, so each code
+# object is only parsed once. Inlining rewrites instructions in place, so
+# the cached instructions are copied with ``_copy_instrs`` before they are
+# used. Entries are evicted when the code object dies, so an id is never
+# reused while it is still in the cache.
+_code_cache = {}
+
+
+def _evict_code(key):
+    _code_cache.pop(key, None)
+
+
+def _extract_and_check(fn):
+    """Extract a Code object from a callable and check if it can be inlined.
+
+    Parameters
+    ----------
+    fn : callable
+        The callable to extract code from.
+
+    Returns
+    -------
+    code : Code or None
+        The code object. This may be shared, copy the instructions with
+        ``_copy_instrs`` before changing them.
+    inlinable : bool
+        Can code be inlined?
+    """
+    if type(fn) is not FunctionType:
+        code = extract_code(fn)
+        return code, code is not None and can_inline(code)
+
+    co = fn.__code__
+    key = id(co)
+    try:
+        return _code_cache[key]
+    except KeyError:
+        pass
+
+    code = Code.from_pycode(co)
+    out = _code_cache[key] = code, can_inline(code)
+    finalize(co, _evict_code, key).atexit = False
+    return out
+
+
+def _copy_instrs(instrs):
+    """Copy instructions so that they can be changed without changing the
+    originals.
+
+    Parameters
+    ----------
+    instrs : tuple[Instruction]
+        The instructions to copy.
+
+    Returns
+    -------
+    copies : tuple[Instruction]
+        The copied instructions. Jumps point at the copies of their targets.
+    """
+    copies = {}
+    out = []
+    append = out.append
+    for instr in instrs:
+        new = object.__new__(type(instr))
+        new.__dict__.update(instr.__dict__)
+        new._target_of = set()
+        new._stolen_by = None
+        copies[id(instr)] = new
+        append(new)
+
+    for new in out:
+        if new.is_jmp:
+            new.arg = target = copies[id(new.arg)]
+            target._target_of.add(new)
+
+    return tuple(out)
+
+
+def _is_unary(code):
+    """Checks if the given code object takes exactly one positional argument.
+
+    Parameters
+    ----------
+    code : Code
+        The code object.
+
+    Returns
+    -------
+    is_unary : bool
+        Is this a function of exactly one argument?
+    """
+    return code.argcount == 1 and len(code.argnames) == 1
+
+
+def _compose2(outer, inner):
+    """Compose the code for two functions by splicing their bodies.
+
+    Parameters
+    ----------
+    outer : Code
+        The inlinable code for the function to call second.
+    inner : Code
+        The inlinable code for the function to call first.
+
+    Returns
+    -------
+    instrs : tuple or None
+        The instructions of the composed function, or None if ``outer`` and
+        ``inner`` are not simple enough to splice together directly.
+
+    Notes
+    -----
+    This handles the case where ``inner`` falls off the end into a single
+    ``RETURN_VALUE`` and ``outer`` only uses its argument as the very first
+    instruction. The result of ``inner`` is then already on the stack where
+    ``outer`` expects its argument so we can concatenate the bodies.
+    """
+    if not (_is_unary(outer) and _is_unary(inner)):
+        return None
+
+    inner_instrs = inner.instrs
+    ret = inner_instrs[-1]
+    if not isinstance(ret, RETURN_VALUE):
+        return None
+
+    for instr in inner_instrs[:-1]:
+        if (isinstance(instr, RETURN_VALUE) or
+                instr.is_jmp and instr.arg is ret):
+            # The return needs to be rewritten into a jump or a store.
+            return None
+
+    outer_instrs = outer.instrs
+    load = outer_instrs[0]
+    if not (isinstance(load, LOAD_FAST) and load.arg == outer.argnames[0]):
+        return None
+
+    for instr in outer_instrs[1:]:
+        if (isinstance(instr, (LOAD_FAST, STORE_FAST, DELETE_FAST)) or
+                instr.is_jmp and instr.arg is load):
+            # The argument is used again or we jump back to the load.
+            return None
+
+    return _copy_instrs(inner_instrs)[:-1] + _copy_instrs(outer_instrs)[1:]
+
+
+def _inline_instrs(code, next_instr, on_stack, argname, first):
+    """Inline a function into the body of the composed function.
+
+    Parameters
+    ----------
+    code : Code
+        The inlinable code object.
+    next_instr : Instruction or None
+        The first instruction of the function called after this one, or None
+        if this is the last function.
+    on_stack : bool
+        Does the function called after this one take its argument from the
+        top of the stack instead of from ``argname``?
+    argname : str
+        The name of the argument of the composed function.
+    first : bool
+        Is this the first function to be called?
+
+    Returns
+    -------
+    instrs : list[Instruction] or None
+        The instructions to use, or None if ``code`` cannot be inlined.
+    from_stack : bool
+        Do ``instrs`` take their argument from the top of the stack?
+    """
+    instrs = _copy_instrs(code.instrs)
+    own = code.argnames[0]
+    rename = own != argname
+    if rename and argname in code.varnames:
+        # Our argument would be renamed to one of our other locals.
+        return None, False
+
+    load = instrs[0]
+    skip = (
+        not first and
+        type(load) is LOAD_FAST and
+        load.arg == own and
+        not load._target_of and
+        not any(
+            type(instr) in _LOCAL_INSTRS and instr.arg == own
+            for instr in instrs[1:]
+        )
+    )
+
+    out = []
+    append = out.append
+    last = len(instrs) - 1
+    for i, instr in enumerate(instrs):
+        t = type(instr)
+        if t is RETURN_VALUE:
+            if next_instr is None:
+                # Actually just return if this is the last function.
+                append(instr)
+                continue
+
+            stolen = False
+            if not on_stack:
+                stolen = True
+                append(STORE_FAST(argname).steal(instr))
+
+            if i != last or not stolen and instr._target_of:
+                # Jump unless we would fall through to ``next_instr``.
+                jmp = JUMP_ABSOLUTE(next_instr)
+                if not stolen:
+                    jmp.steal(instr)
+                append(jmp)
+        elif i == 0 and skip:
+            # The function called before us leaves our argument on the
+            # stack.
+            continue
+        else:
+            if rename and t in _LOCAL_INSTRS and instr.arg == own:
+                instr.arg = argname
+            append(instr)
+
+    return out, skip
+
+
+def _make_function(instrs, argnames, name, defaults, called=()):
+    """Create the composed function object.
+
+    Parameters
+    ----------
+    instrs : iterable[Instruction]
+        The body of the composed function.
+    argnames : tuple[str]
+        The argument names of the composed function.
+    name : str
+        The name of the composed function.
+    defaults : tuple or None
+        The defaults of the innermost function.
+    called : tuple[callable], optional
+        The functions loaded from the free variables ``_0``, ``_1``, ...
+
+    Returns
+    -------
+    composed : function
+        The composed function.
+
+    Notes
+    -----
+    Functions which use closures are called instead of inlined, so the only
+    free variables are the ones holding ``called``.
+    """
+    freevars = tuple('_%d' % n for n in range(len(called)))
+    return FunctionType(
+        _intern_code(
+            Code(instrs, argnames, freevars=freevars, name=name).to_pycode(),
+        ),
+        {},
+        name,
+        defaults,
+        tuple(map(_make_cell, called)) or None,
+    )
+
+
+def compose_inline(fs, name, defaults):
+    """Compose functions together by inlining their ``Code`` objects.
+
+    Parameters
+    ----------
+    fs : tuple[callable]
+        The functions to compose, outermost first.
+    name : str
+        The name of the composed function.
+    defaults : tuple or None
+        The defaults of the innermost function.
+
+    Returns
+    -------
+    composed : function
+        The compositions of all of the functions.
+    """
+    cs, inlinable = zip(*map(_extract_and_check, fs))
+    if (len(fs) == 2 and
+            all(inlinable) and
+            all(isinstance(f, FunctionType) for f in fs)):
+        instrs = _compose2(cs[0], cs[1])
+        if instrs is not None:
+            return _make_function(instrs, cs[1].argnames, name, defaults)
+
+    argname = cs[-1].argnames[0] if cs[-1] is not None else 'n'
+    flat_instrs = []
+    extend_instrs = flat_instrs.extend
+    first_index = len(fs) - 1
+    called = []
+    next_instr = None
+    on_stack = False
+    for i, (f, c, can_inline_c) in enumerate(zip(fs, cs, inlinable)):
+        first = i == first_index
+        instrs = None
+        if can_inline_c:
+            instrs, from_stack = _inline_instrs(
+                c,
+                next_instr,
+                on_stack,
+                argname,
+                first,
+            )
+
+        if instrs is None:
+            instrs = _call_free('_%d' % len(called))
+            called.append(f)
+            from_stack = not first
+            if first:
+                instrs = (LOAD_FAST(argname),) + instrs
+            if i == 0:
+                instrs += (RETURN_VALUE(),)
+            elif not on_stack:
+                instrs += (STORE_FAST(argname),)
+
+        if instrs:
+            # An empty body passes its argument straight through, so the
+            # function called before it should jump to the same place.
+            next_instr = instrs[0]
+            on_stack = from_stack
+
+        # Each function needs to know the first instruction of the function
+        # that is called after it, so we visit the functions outermost first
+        # and build the body back to front.
+        extend_instrs(reversed(instrs))
+
+    flat_instrs.reverse()
+    return _make_function(
+        flat_instrs,
+        cs[-1].argnames if cs[-1] is not None else ('n',),
+        name,
+        defaults,
+        tuple(called),
+    )
@@ -0,0 +1,419 @@
+import dis
+import gc
+import subprocess
+import sys
+import weakref
+
+from codetransformer import Code
+import pytest
+
+from gotenks._compose import compose_functions
+from gotenks.compose import _intern_code, compose
+from gotenks.inline import compose_inline
+
+
+def f(a):
+    return a + 1
+
+
+def g(a):
+    return a * 2
+
+
+def test_compose():
+    f_of_g = compose(f, g)
+
+    assert f_of_g.__name__ == 'f_of_g'
+    for n in range(5):
+        assert f_of_g(n) == f(g(n))
+
+
+def test_compose_two_splices_bodies():
+    opnames = [instr.opname for instr in dis.get_instructions(compose(f, g))]
+    assert opnames == [
+        'LOAD_FAST',
+        'LOAD_CONST',
+        'BINARY_MULTIPLY',
+        'LOAD_CONST',
+        'BINARY_ADD',
+        'RETURN_VALUE',
+    ]
+
+
+def test_compose_shares_non_inlinable():
+    def uses_global(a):
+        return len(str(a))
+
+    pipelines = [
+        (uses_global, f),
+        (f, uses_global),
+        (g, uses_global, f),
+    ]
+    for _ in range(2):
+        for fs in pipelines:
+            composed = compose(*fs)
+            for n in (1, 10, 100):
+                expected = n
+                for fn in reversed(fs):
+                    expected = fn(expected)
+                assert composed(n) == expected
+
+
+def test_compose_inline():
+    def reuse(x):
+        y = x + 1
+        return y * x
+
+    def clamp(a):
+        if a > 3:
+            return 3
+        return a
+
+    def shadow(x):
+        a = x + 1
+        return a + x
+
+    def uses_global(a):
+        return len(str(a))
+
+    def deletes(x):
+        b = x
+        del x
+        return b
+
+    pipelines = [
+        (reuse, f),
+        (deletes, f),
+        (f, deletes, g),
+        (f, clamp, g),
+        (clamp, reuse, g, f),
+        (shadow, f),
+        (g, shadow, clamp),
+        (f, f),
+        (uses_global, g, uses_global),
+        (uses_global, uses_global, clamp),
+    ]
+    for fs in pipelines:
+        composed = compose_inline(fs, 'composed', None)
+        for n in range(-2, 6):
+            expected = n
+            for fn in reversed(fs):
+                expected = fn(expected)
+            assert composed(n) == expected
+
+
+def test_compose_inline_closure():
+    offset = 3
+
+    def uses_closure(a):
+        return a + offset
+
+    for fs in (f, uses_closure), (uses_closure, f), (f, uses_closure, g):
+        composed = compose_inline(fs, 'composed', None)
+        cells = composed.__closure__
+        assert [cell.cell_contents for cell in cells] == [uses_closure]
+        for n in range(-2, 3):
+            expected = n
+            for fn in reversed(fs):
+                expected = fn(expected)
+            assert composed(n) == expected
+
+
+def test_compose_inline_reuses_parse(monkeypatch):
+    def clamp(a):
+        if a > 3:
+            return 3
+        return a
+
+    pipelines = [(clamp, g), (clamp, clamp), (f, clamp, clamp)]
+    for fs in pipelines:
+        compose_inline(fs, 'composed', None)
+
+    def from_pycode(co):
+        raise AssertionError('parsed {co!r} again'.format(co=co))
+
+    monkeypatch.setattr(Code, 'from_pycode', from_pycode)
+    for _ in range(2):
+        for fs in pipelines:
+            composed = compose_inline(fs, 'composed', None)
+            for n in range(-2, 6):
+                expected = n
+                for fn in reversed(fs):
+                    expected = fn(expected)
+                assert composed(n) == expected
+
+
+def test_compose_cached():
+    assert compose(f, g) is compose(f, g)
+    assert compose(f, g) is not compose(g, f)
+
+
+def test_compose_cache_defaults():
+    def h(a=1):
+        return a - 1
+
+    first = compose(f, h)
+    assert first() == 1
+
+    h.__defaults__ = (2,)
+    second = compose(f, h)
+    assert second is not first
+    assert second() == 2
+
+
+def test_compose_unhashable():
+    class Unhashable:
+        __hash__ = None
+
+        def __call__(self, a):
+            return a * 3
+
+    unhashable = Unhashable()
+    first = compose(f, unhashable)
+    assert first(2) == f(unhashable(2))
+    assert compose(f, unhashable) is first
+
+
+def test_compose_cache_identity():
+    class Equal:
+        def __init__(self, factor):
+            self.factor = factor
+
+        def __eq__(self, other):
+            return isinstance(other, Equal)
+
+        def __hash__(self):
+            return 0
+
+        def __call__(self, a):
+            return a * self.factor
+
+    double = compose(Equal(2), f)
+    assert double(1) == 4
+    assert compose(Equal(3), f)(1) == 6
+
+    def h(a=1):
+        return a
+
+    first = compose(f, h)
+    h.__defaults__ = (1.0,)
+    second = compose(f, h)
+    assert second is not first
+    assert type(second()) is float
+
+    def k(a):
+        return a + 1
+
+    def other(a):
+        return a - 1
+
+    first = compose(f, k)
+    assert first(0) == 2
+    k.__code__ = other.__code__
+    assert compose(f, k)(0) == 0
+
+
+def test_compose_cache_is_weak():
+    class Captured:
+        def __call__(self, a):
+            return a
+
+    def make(captured):
+        def h(a):
+            return captured(a)
+
+        return h
+
+    captured = Captured()
+    captured_ref = weakref.ref(captured)
+    assert compose(f, make(captured))(1) == 2
+    del captured
+    gc.collect()
+    assert captured_ref() is None
+
+
+def test_compose_cache_cycle_is_weak():
+    class Holder:
+        def __call__(self, a):
+            return a
+
+    holder = Holder()
+    holder_ref = weakref.ref(holder)
+    holder.composed = compose(holder, f)
+    assert holder.composed(1) == 2
+    del holder
+    gc.collect()
+    assert holder_ref() is None
+
+
+wordcode = pytest.mark.skipif(
+    not (3, 6) <= sys.version_info < (3, 8),
+    reason='compose_functions only writes 3.6 and 3.7 wordcode',
+)
+
+
+@wordcode
+def test_compose_functions():
+    def square(a):
+        return a * a
+
+    def wrap(a):
+        b = a % 10
+        return b or a
+
+    def shift(a):
+        b = a - 1
+        return b and b + 1
+
+    composed = compose(shift, wrap, square, f)
+    assert composed.__code__.co_name == 'shift_of_wrap_of_square_of_f'
+    assert composed.__doc__ is None
+    for n in range(-3, 5):
+        assert composed(n) == shift(wrap(square(f(n))))
+
+
+@wordcode
+def test_compose_functions_calls():
+    def uses_global(a):
+        return len(str(a))
+
+    offset = 3
+
+    def uses_closure(a):
+        return a + offset
+
+    composed = compose(g, uses_global, str, f, uses_closure)
+    assert [cell.cell_contents for cell in composed.__closure__] == [
+        uses_closure,
+        str,
+        uses_global,
+    ]
+    for n in (1, 10, 100):
+        assert composed(n) == g(uses_global(str(f(uses_closure(n)))))
+
+
+@wordcode
+def test_compose_functions_consts():
+    def documented(a):
+        """A docstring.
+        """
+        return a + 1.0
+
+    def prefix(a):
+        return 'x' + a
+
+    composed = compose(f, documented, f, f)
+    assert composed.__code__.co_consts == (1, 1.0)
+    assert composed(1) == 5.0
+    assert type(composed(1)) is float
+
+    composed = compose(str.upper, prefix)
+    assert composed.__doc__ is None
+    assert composed('y') == 'XY'
+
+
+@wordcode
+def test_compose_functions_declines():
+    def nonunary(a, b):
+        return a + b
+
+    assert compose_functions((nonunary, f), 'c') is None
+    assert compose_functions((f, 1), 'c') is None
+
+    with pytest.raises(TypeError):
+        compose_functions([f, g], 'c')
+
+
+def test_import_does_not_load_codetransformer():
+    subprocess.check_call([
+        sys.executable,
+        '-c',
+        'import sys, gotenks.fused; '
+        'assert "codetransformer" not in sys.modules',
+    ])
+
+
+def test_compose_shares_code():
+    def make():
+        def h(a):
+            return a - 1
+
+        return h
+
+    first = compose(f, make())
+    second = compose(f, make())
+    assert first is not second
+    assert first.__code__ is second.__code__
+    assert first(1) == second(1) == 1
+
+
+@wordcode
+def test_intern_code_is_weak():
+    class Captured:
+        def __eq__(self, other):
+            raise AssertionError('compared constants')
+
+        def __hash__(self):
+            return 0
+
+        def __call__(self, a):
+            return a
+
+    captured = Captured()
+    captured_ref = weakref.ref(captured)
+    code, closure = compose_functions((f, captured), 'c')
+    assert _intern_code(code) is code
+    assert _intern_code(compose_functions((f, captured), 'c')[0]) is code
+
+    del code, closure, captured
+    gc.collect()
+    assert captured_ref() is None
+
+
+def test_intern_code_identity():
+    class Equal:
+        def __init__(self, factor):
+            self.factor = factor
+
+        def __eq__(self, other):
+            return isinstance(other, Equal)
+
+        def __hash__(self):
+            return 0
+
+        def __call__(self, a):
+            return a * self.factor
+
+    double = compose_inline((Equal(2), f), 'composed', None)
+    triple = compose_inline((Equal(3), f), 'composed', None)
+    assert double(1) == 4
+    assert triple(1) == 6
+
+    def plus_int(a):
+        return a + 1
+
+    def plus_float(a):
+        return a + 1.0
+
+    assert type(compose_inline((plus_int, g), 'composed', None)(1)) is int
+    assert type(compose_inline((plus_float, g), 'composed', None)(1)) is float
+
+    def make():
+        def h(a):
+            return a - 1
+
+        return h
+
+    first = compose_inline((g, make()), 'composed', None)
+    second = compose_inline((g, make()), 'composed', None)
+    assert first.__code__ is second.__code__
+
+
+def test_compose_helpers():
+    from gotenks.compose import can_inline, call_function, extract_code
+
+    code = extract_code(f)
+    assert code.argnames == ('a',)
+    assert can_inline(code)
+    assert extract_code(len) is None
+    assert call_function(f)[0].arg is f
@@ -44,6 +44,12 @@ setup(
             language='c++',
             extra_compile_args=cflags,
         ),
+        Extension(
+            'gotenks._compose',
+            ['gotenks/_compose.cc'],
+            language='c++',
+            extra_compile_args=cflags,
+        ),
     ],
     install_requires=[
         'codetransformer',